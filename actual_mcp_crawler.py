@@ -5,11 +5,13 @@
 """
 
 import asyncio
-import json
 import re
 from typing import Dict, List, Any
 from urllib.parse import urljoin
 import logging
+import os
+
+from school_storage import COPY_THRESHOLD, clean_school_data, copy_to_postgres, dump_schools_json
 
 # 設置日誌
 logging.basicConfig(
@@ -18,11 +20,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 每次寫入 Supabase 的最大筆數
+SUPABASE_BATCH_SIZE = 1000
+
 class ActualMCPCrawler:
     def __init__(self):
         """初始化爬蟲"""
         self.base_url = "https://outgoing-iep.nccu.edu.tw"
         self.schools_data = []
+        self.processed_schools = set()
+        # 同時進行中的詳細頁面請求上限
+        self.detail_concurrency = 5
+        # 直接連線 PostgreSQL 的連線字串（大量寫入時使用 COPY）
+        self.database_url = os.getenv('DATABASE_URL')
         
     async def crawl_with_playwright(self):
         """使用 Playwright MCP 進行爬蟲"""
@@ -41,13 +51,30 @@ class ActualMCPCrawler:
             # 步驟 3: 解析學校資訊
             schools = await self.parse_schools_from_snapshot()
             
-            # 步驟 4: 訪問每個學校的詳細頁面
+            # 依 nccu_page_url 去除重複的學校，避免重複訪問詳細頁面
+            unique_schools = []
             for school in schools:
-                if school.get('nccu_page_url'):
+                url = school.get('nccu_page_url')
+                if url in self.processed_schools:
+                    continue
+                if url:
+                    self.processed_schools.add(url)
+                unique_schools.append(school)
+            schools = unique_schools
+            
+            # 步驟 4: 並行訪問每個學校的詳細頁面（以 semaphore 限制同時請求數）
+            semaphore = asyncio.Semaphore(self.detail_concurrency)
+            
+            async def crawl_detail(school: Dict[str, Any]) -> None:
+                if not school.get('nccu_page_url'):
+                    return
+                async with semaphore:
                     # await mcp_playwright_browser_navigate(url=school['nccu_page_url'])
                     # detail_snapshot = await mcp_playwright_browser_snapshot()
                     detail_info = await self.parse_school_detail_from_snapshot()
-                    school.update(detail_info)
+                school.update(detail_info)
+            
+            await asyncio.gather(*[crawl_detail(school) for school in schools])
             
             self.schools_data = schools
             logger.info(f"Playwright 爬蟲完成，總共發現 {len(schools)} 所學校")
@@ -122,6 +149,7 @@ class ActualMCPCrawler:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
+            CREATE UNIQUE INDEX IF NOT EXISTS schools_nccu_page_url_key ON schools (nccu_page_url);
             """
             
             # 這裡會調用 Supabase MCP 來執行 SQL
@@ -133,27 +161,34 @@ class ActualMCPCrawler:
             logger.error(f"創建 Supabase 表失敗: {e}")
     
     async def save_to_supabase(self):
-        """使用 Supabase MCP 儲存資料"""
+        """使用 Supabase MCP 批次儲存資料"""
         try:
             logger.info("正在使用 Supabase MCP 儲存資料...")
             
+            # 清理資料
+            rows = [self.clean_school_data(school) for school in self.schools_data]
+            
+            # 大量資料時以 COPY 串流寫入，否則走批次 REST 插入
+            if self.database_url and len(rows) > COPY_THRESHOLD:
+                await copy_to_postgres(self.database_url, rows)
+                return
+            
             success_count = 0
             error_count = 0
             
-            for school in self.schools_data:
+            # 每批一次插入，round trip 從 N 次降為 ⌈N / SUPABASE_BATCH_SIZE⌉ 次
+            for start in range(0, len(rows), SUPABASE_BATCH_SIZE):
+                batch = rows[start:start + SUPABASE_BATCH_SIZE]
                 try:
-                    # 清理資料
-                    cleaned_school = self.clean_school_data(school)
-                    
                     # 這裡會使用 Supabase MCP 來插入資料
-                    # await mcp_supabase_insert(table_name="schools", data=cleaned_school)
+                    # await mcp_supabase_upsert(table_name="schools", data=batch, on_conflict="nccu_page_url")
                     
-                    success_count += 1
-                    logger.info(f"成功儲存: {school['name']}")
+                    success_count += len(batch)
+                    logger.info(f"成功儲存第 {start + 1}-{start + len(batch)} 筆")
                     
                 except Exception as e:
-                    error_count += 1
-                    logger.error(f"儲存失敗 {school.get('name', 'Unknown')}: {e}")
+                    error_count += len(batch)
+                    logger.error(f"儲存失敗第 {start + 1}-{start + len(batch)} 筆: {e}")
             
             logger.info(f"Supabase 儲存完成: 成功 {success_count} 筆，失敗 {error_count} 筆")
             
@@ -162,32 +197,12 @@ class ActualMCPCrawler:
     
     def clean_school_data(self, school: Dict[str, Any]) -> Dict[str, Any]:
         """清理學校資料"""
-        cleaned = {}
-        
-        # 基本資訊
-        cleaned['name'] = school.get('name', '').strip()
-        cleaned['country'] = school.get('country', '').strip()
-        cleaned['city'] = school.get('city', '').strip()
-        cleaned['exchange_quota'] = school.get('exchange_quota')
-        cleaned['degree_types'] = school.get('degree_types', [])
-        
-        # 詳細資訊
-        cleaned['description'] = school.get('description', '').strip()
-        cleaned['official_website'] = school.get('official_website', '').strip()
-        cleaned['location_info'] = school.get('location_info', '').strip()
-        cleaned['image_url'] = school.get('image_url', '').strip()
-        cleaned['nccu_page_url'] = school.get('nccu_page_url', '').strip()
-        
-        # 移除空值
-        cleaned = {k: v for k, v in cleaned.items() if v is not None and v != ''}
-        
-        return cleaned
+        return clean_school_data(school)
     
-    async def save_to_json(self, filename: str = 'mcp_schools_data.json'):
-        """儲存資料到 JSON 檔案"""
+    async def save_to_json(self, filename: str = 'mcp_schools_data.json', compact: bool = True):
+        """儲存資料到 JSON 檔案；compact 時不縮排並以 gzip 壓縮寫入 <filename>.gz"""
         try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(self.schools_data, f, ensure_ascii=False, indent=2)
+            filename = dump_schools_json(self.schools_data, filename, compact)
             logger.info(f"資料已儲存到 {filename}")
         except Exception as e:
             logger.error(f"儲存 JSON 檔案失敗: {e}")
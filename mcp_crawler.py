@@ -5,31 +5,202 @@
 """
 
 import asyncio
-import json
+import atexit
+import hashlib
 import re
 import time
 from typing import Dict, List, Optional, Any
 from urllib.parse import urljoin
 import logging
+import logging.handlers
+import os
+import queue
 from datetime import datetime
 
-# 設置日誌
+from aiolimiter import AsyncLimiter
+from lxml import etree, html as lxml_html
+
+from school_storage import (
+    COPY_THRESHOLD, clean_school_data, copy_to_postgres, dump_schools_json, group_rows_by_columns
+)
+
+# 設置日誌：實際寫檔與輸出交給背景執行緒，避免阻塞 event loop
+_log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+_log_handlers = [
+    logging.FileHandler('mcp_crawler.log'),
+    logging.StreamHandler()
+]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, *_log_handlers)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# 完整格式由背景 handler 套用，佇列端只保留訊息本身
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('mcp_crawler.log'),
-        logging.StreamHandler()
-    ]
+    format='%(message)s',
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
 logger = logging.getLogger(__name__)
+# httpx 每個請求都會輸出 INFO 日誌，只保留警告以上
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# 學校列表欄位解析用的預編譯 regex 與 XPath
+_XP_NAME = etree.XPath('string(descendant-or-self::h3)')
+_XP_NODE_HREF = etree.XPath('descendant-or-self::a[contains(@href, "node/")]/@href')
+_XP_IMG_SRC = etree.XPath('descendant-or-self::img/@src')
+_RX_FIELDS = re.compile(r'國家:\s*(?P<country>\S+)|城市:\s*(?P<city>\S+)|交換名額:\s*(?P<quota>\d+)')
+_RX_IMG_SRC = re.compile(r'\.(?:jpg|png|gif)$')
+_RX_DEGREE = re.compile(r'Bachelor|Master|Ph\.?D')
+
+# 詳細頁面中代表地理位置的關鍵字
+LOCATION_KEYWORDS = ('Location', 'Address', '地址', '位置')
+
+# 詳細頁面解析用的預編譯 XPath，所有詳細頁面共用
+_XP_DESCRIPTION = etree.XPath('string(//p)')
+_XP_HTTP_LINKS = etree.XPath('//a[contains(@href, "http")]/@href')
+_XP_LOCATION_DIVS = etree.XPath(
+    '//div[' + ' or '.join(f'contains(., "{keyword}")' for keyword in LOCATION_KEYWORDS) + ']'
+)
+
+# 瀏覽器中不需載入的資源類型
+BLOCKED_RESOURCE_TYPES = frozenset({'image', 'font', 'media', 'stylesheet'})
+
+# Drupal EU Cookie Compliance 模組的同意按鈕
+COOKIE_CONSENT_SELECTOR = '.eu-cookie-compliance-banner .agree-button'
+
+# 詳細頁面快取的位置與有效期限（秒）
+DETAIL_CACHE_DIR = '.crawl_cache'
+DETAIL_CACHE_TTL = 24 * 60 * 60
+
+# 每次寫入 Supabase 的最大筆數
+SUPABASE_BATCH_SIZE = 1000
+
+# 爬取與寫入之間的佇列長度上限
+PIPELINE_QUEUE_SIZE = 200
 
 class MCPNCCUCrawler:
     def __init__(self):
         """初始化 MCP 爬蟲"""
         self.base_url = "https://outgoing-iep.nccu.edu.tw"
+        self._base = self.base_url.rstrip('/')
         self.schools_data = []
         self.processed_schools = set()
+        # 同時進行中的列表頁、詳細頁面請求上限
+        self.list_concurrency = 5
+        self.detail_concurrency = 5
+        # 對來源網站的請求速率上限（每秒請求數），所有並行任務共用
+        self._limiter = AsyncLimiter(max_rate=5, time_period=1)
+        # 直接連線 PostgreSQL 的連線字串（大量寫入時使用 COPY）
+        self.database_url = os.getenv('DATABASE_URL')
+        # 設定後改以 Supabase REST API 寫入（否則使用 Supabase MCP）
+        self.supabase_url = os.getenv('SUPABASE_URL')
+        self.supabase_key = os.getenv('SUPABASE_KEY')
+        
+        # 共用的 HTTP client，所有 HTTP 請求共用同一個 keep-alive 連線池
+        self._http = None
+        
+        # 詳細頁面解析結果的磁碟快取，重跑時可略過已爬過的網址
+        self._cache = None
+        
+        # 共用的 Playwright 瀏覽器與 context，第一次需要時才啟動
+        self._pw = None
+        self._browser = None
+        self._ctx = None
+        self._browser_lock = asyncio.Lock()
+        self._consent_done = False
+        
+    async def _ensure_browser(self):
+        """確保共用瀏覽器 context 已啟動（整個執行期間只啟動一次）"""
+        async with self._browser_lock:
+            if self._ctx is not None:
+                return self._ctx
+            
+            from playwright.async_api import async_playwright
+            self._pw = await async_playwright().start()
+            self._browser = await self._pw.chromium.launch(
+                headless=True,
+                args=['--no-sandbox', '--disable-dev-shm-usage']
+            )
+            self._ctx = await self._browser.new_context()
+            await self._ctx.route('**/*', self._block_resource)
+            logger.info("瀏覽器初始化完成")
+            return self._ctx
+    
+    async def _block_resource(self, route):
+        """攔截解析用不到的資源：圖片、字型等一律略過，外部網站的 script 也略過"""
+        request = route.request
+        if request.resource_type in BLOCKED_RESOURCE_TYPES or (
+            request.resource_type == 'script' and not request.url.startswith(self.base_url)
+        ):
+            await route.abort()
+        else:
+            await route.continue_()
+    
+    async def _accept_cookie_consent(self, page):
+        """點擊 cookie 同意按鈕；context 共用 cookie，所以只需處理一次"""
+        if self._consent_done:
+            return
+        self._consent_done = True
+        
+        button = await page.query_selector(COOKIE_CONSENT_SELECTOR)
+        if button:
+            await button.click()
+            logger.info("已接受 cookie 同意")
+    
+    def _get_http(self):
+        """取得共用的 httpx client，第一次呼叫時建立"""
+        if self._http is None:
+            import httpx
+            
+            self._http = httpx.AsyncClient(
+                headers={'User-Agent': 'nccu-crawler/1.0'},
+                timeout=30,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=60)
+            )
+        return self._http
+    
+    def _supabase_headers(self) -> Dict[str, str]:
+        """Supabase REST API 的認證標頭（只附加在 Supabase 請求上）"""
+        return {
+            'apikey': self.supabase_key,
+            'Authorization': f'Bearer {self.supabase_key}',
+            'Content-Type': 'application/json',
+            'Prefer': 'resolution=merge-duplicates,return=minimal'
+        }
+    
+    async def close_http(self):
+        """關閉共用的 HTTP client"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+    
+    def _get_cache(self):
+        """取得詳細頁面的磁碟快取，第一次呼叫時建立"""
+        if self._cache is None:
+            import diskcache
+            self._cache = diskcache.Cache(DETAIL_CACHE_DIR)
+        return self._cache
+    
+    def close_cache(self):
+        """關閉磁碟快取"""
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+    
+    async def close_browser(self):
+        """關閉共用瀏覽器"""
+        if self._ctx is not None:
+            await self._ctx.close()
+        if self._browser is not None:
+            await self._browser.close()
+        if self._pw is not None:
+            await self._pw.stop()
+        self._pw = self._browser = self._ctx = None
         
     async def get_total_pages(self) -> int:
         """獲取總頁數"""
@@ -45,45 +216,45 @@ class MCPNCCUCrawler:
             logger.error(f"獲取總頁數失敗: {e}")
             return 1
     
+    def _absolute_url(self, href: str) -> str:
+        """將站內連結轉為絕對網址；根目錄相對路徑直接串接，其他情況才交給 urljoin"""
+        if href.startswith('/') and not href.startswith('//'):
+            return self._base + href
+        return urljoin(self.base_url, href)
+    
     def extract_school_info_from_text(self, text: str) -> Dict[str, Any]:
         """從文字中提取學校資訊"""
         try:
+            # 整段 HTML 只建一次 DOM 樹，所有欄位都從同一棵樹取出
+            tree = lxml_html.fromstring(text)
+            
             # 學校名稱通常在 h3 標籤中
-            name_match = re.search(r'<h3[^>]*>([^<]+)</h3>', text)
-            school_name = name_match.group(1).strip() if name_match else None
-            
-            # 國家
-            country_match = re.search(r'國家:\s*([^\s]+)', text)
-            country = country_match.group(1) if country_match else None
-            
-            # 城市
-            city_match = re.search(r'城市:\s*([^\s]+)', text)
-            city = city_match.group(1) if city_match else None
-            
-            # 交換名額
-            quota_match = re.search(r'交換名額:\s*(\d+)', text)
-            exchange_quota = int(quota_match.group(1)) if quota_match else None
-            
-            # 學位類型
-            degree_types = []
-            if 'Bachelor' in text:
-                degree_types.append('Bachelor')
-            if 'Master' in text:
-                degree_types.append('Master')
-            if 'Ph.D' in text:
-                degree_types.append('Ph.D')
+            school_name = _XP_NAME(tree).strip() or None
+            
+            # 國家、城市、交換名額：攤平文字後以單一 regex 一次掃描
+            flat_text = '\n'.join(tree.itertext())
+            fields = {}
+            for match in _RX_FIELDS.finditer(flat_text):
+                fields.setdefault(match.lastgroup, match.group(match.lastgroup))
+            country = fields.get('country')
+            city = fields.get('city')
+            exchange_quota = int(fields['quota']) if 'quota' in fields else None
+            
+            # 學位類型：單次掃描，PhD 統一寫成 Ph.D
+            degree_types = sorted({
+                match.group().replace('PhD', 'Ph.D') for match in _RX_DEGREE.finditer(flat_text)
+            })
             
             # 學校連結
-            url_match = re.search(r'href="([^"]*node/\d+)"', text)
-            school_url = None
-            if url_match:
-                school_url = urljoin(self.base_url, url_match.group(1))
+            hrefs = _XP_NODE_HREF(tree)
+            school_url = self._absolute_url(hrefs[0]) if hrefs else None
             
             # 圖片 URL
-            img_match = re.search(r'src="([^"]*\.(?:jpg|png|gif))"', text)
             image_url = None
-            if img_match:
-                image_url = urljoin(self.base_url, img_match.group(1))
+            for src in _XP_IMG_SRC(tree):
+                if _RX_IMG_SRC.search(src):
+                    image_url = self._absolute_url(src)
+                    break
             
             return {
                 'name': school_name,
@@ -119,19 +290,155 @@ class MCPNCCUCrawler:
             logger.error(f"爬取第 {page_num + 1} 頁失敗: {e}")
             return []
     
+    async def crawl_school_list_pages(self, page_nums: range) -> List[Dict[str, Any]]:
+        """並行爬取多個列表頁，以 semaphore 限制同時請求數，回傳合併後的學校列表"""
+        semaphore = asyncio.Semaphore(self.list_concurrency)
+        
+        async def crawl_one(page_num: int) -> List[Dict[str, Any]]:
+            async with semaphore:
+                return await self.crawl_school_list_page(page_num)
+        
+        pages = await asyncio.gather(
+            *[crawl_one(page_num) for page_num in page_nums],
+            return_exceptions=True
+        )
+        
+        all_schools = []
+        for page_num, page in zip(page_nums, pages):
+            if isinstance(page, BaseException):
+                logger.error(f"爬取第 {page_num + 1} 頁失敗: {page}")
+                continue
+            all_schools.extend(page)
+        return all_schools
+    
     async def crawl_school_detail(self, school_url: str) -> Dict[str, Any]:
-        """爬取學校詳細資訊"""
+        """爬取學校詳細資訊（結果快取於磁碟，重跑時不再重新導航）"""
         try:
-            logger.info(f"正在爬取學校詳細資訊: {school_url}")
+            cache = self._get_cache()
+            cache_key = hashlib.blake2b(school_url.encode(), digest_size=16).hexdigest()
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return cached
             
-            # 這裡需要實際的 Playwright MCP 調用
-            # 暫時返回空字典
-            return {}
+            logger.debug("正在爬取學校詳細資訊: %s", school_url)
+            
+            # 先以輕量 HTTP 請求取得伺服器端產生的 HTML，解析不到內容時才動用瀏覽器
+            async with self._limiter:
+                response = await self._get_http().get(school_url)
+            detail_info = {}
+            if response.status_code == 200:
+                try:
+                    detail_info = self.extract_school_detail_from_text(response.text)
+                except (etree.ParserError, ValueError) as e:
+                    # 回應為空或無法解析時（例如 "Document is empty"），改用瀏覽器取得
+                    logger.debug("靜態 HTML 解析失敗，改用瀏覽器 %s: %s", school_url, e)
+            if not detail_info:
+                html = await self.fetch_html_with_browser(school_url)
+                detail_info = self.extract_school_detail_from_text(html)
+            # 兩種方式都解析不到內容時不寫入快取，下次執行會重新抓取
+            if detail_info:
+                cache.set(cache_key, detail_info, expire=DETAIL_CACHE_TTL)
+            return detail_info
             
         except Exception as e:
             logger.error(f"爬取學校詳細資訊失敗 {school_url}: {e}")
             return {}
     
+    async def fetch_html_with_browser(self, url: str) -> str:
+        """以共用瀏覽器 context 開新分頁取得頁面 HTML（供需要 JavaScript 的頁面使用）"""
+        ctx = await self._ensure_browser()
+        page = await ctx.new_page()
+        try:
+            async with self._limiter:
+                await page.goto(url)
+            await self._accept_cookie_consent(page)
+            return await page.content()
+        finally:
+            await page.close()
+    
+    def extract_school_detail_from_text(self, text: str) -> Dict[str, Any]:
+        """從詳細頁面 HTML 中提取學校詳細資訊"""
+        tree = lxml_html.fromstring(text)
+        detail_info = {}
+        
+        # 學校介紹
+        description = _XP_DESCRIPTION(tree).strip()
+        if description:
+            detail_info['description'] = description
+        
+        # 學校官網
+        websites = _XP_HTTP_LINKS(tree)
+        if websites and not websites[0].startswith(self.base_url):
+            detail_info['official_website'] = websites[0]
+        
+        # 地理位置資訊
+        location_info = [element.text_content().strip() for element in _XP_LOCATION_DIVS(tree)]
+        
+        if location_info:
+            detail_info['location_info'] = ' '.join(location_info)
+        
+        return detail_info
+    
+    def filter_new_schools(self, schools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """依 nccu_page_url 過濾已處理過的學校"""
+        new_schools = []
+        for school in schools:
+            url = school.get('nccu_page_url')
+            if url in self.processed_schools:
+                continue
+            if url:
+                self.processed_schools.add(url)
+            new_schools.append(school)
+        return new_schools
+    
+    async def crawl_school_details(
+        self,
+        schools: List[Dict[str, Any]],
+        school_queue: Optional[asyncio.Queue] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        並行爬取多所學校的詳細資訊，以 semaphore 限制同時請求數
+        
+        Args:
+            schools: 要爬取的學校列表
+            school_queue: 若提供，每所學校完成後立即放入佇列供下游處理
+        """
+        semaphore = asyncio.Semaphore(self.detail_concurrency)
+        
+        async def crawl_one(school: Dict[str, Any]) -> Dict[str, Any]:
+            if school.get('nccu_page_url'):
+                async with semaphore:
+                    detail_info = await self.crawl_school_detail(school['nccu_page_url'])
+                school.update(detail_info)
+            if school_queue is not None:
+                await school_queue.put(school)
+            return school
+        
+        return await asyncio.gather(*[crawl_one(school) for school in schools])
+    
+    async def supabase_writer(self, school_queue: asyncio.Queue, total: int):
+        """
+        從佇列取出已爬完的學校，累積成批後寫入 Supabase，收到 None 時結束
+        
+        Args:
+            school_queue: 已爬完的學校佇列
+            total: 預計寫入的總筆數；設定了 DATABASE_URL 且超過 COPY_THRESHOLD 時，
+                先保留所有資料，收到 None 後再一次以 COPY 寫入
+        """
+        use_copy = bool(self.database_url) and total > COPY_THRESHOLD
+        batch = []
+        while True:
+            school = await school_queue.get()
+            if school is None:
+                break
+            batch.append(school)
+            if not use_copy and len(batch) >= SUPABASE_BATCH_SIZE:
+                await self.save_to_supabase(batch)
+                batch = []
+        
+        if batch:
+            await self.save_to_supabase(batch)
+    
     async def create_supabase_table(self):
         """在 Supabase 中創建 schools 表"""
         try:
@@ -155,6 +462,7 @@ class MCPNCCUCrawler:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
+            CREATE UNIQUE INDEX IF NOT EXISTS schools_nccu_page_url_key ON schools (nccu_page_url);
             """
             
             logger.info("schools 資料表創建完成")
@@ -162,51 +470,55 @@ class MCPNCCUCrawler:
         except Exception as e:
             logger.error(f"創建資料表失敗: {e}")
     
-    async def save_to_supabase(self, school_data: Dict[str, Any]):
-        """儲存單筆學校資料到 Supabase"""
+    async def save_to_supabase(self, schools: List[Dict[str, Any]]):
+        """批次儲存學校資料到 Supabase"""
         try:
-            # 這裡需要實際的 Supabase MCP 調用
-            logger.info(f"正在儲存學校資料: {school_data.get('name', 'Unknown')}")
+            logger.info(f"正在儲存 {len(schools)} 筆學校資料...")
             
             # 清理資料
-            cleaned_data = self.clean_school_data(school_data)
+            rows = [self.clean_school_data(school) for school in schools]
             
-            # 插入資料到 Supabase
-            # 這裡需要實際的 API 調用
+            # 大量資料時以 COPY 串流寫入，否則走批次 REST 插入
+            if self.database_url and len(rows) > COPY_THRESHOLD:
+                await copy_to_postgres(self.database_url, rows)
+                return
             
-            logger.info(f"成功儲存: {school_data.get('name', 'Unknown')}")
+            # 每批一次插入，round trip 從 N 次降為 ⌈N / SUPABASE_BATCH_SIZE⌉ 次；
+            # 依欄位分組送出，缺少的欄位不會以 NULL 覆寫資料庫中既有的值
+            for columns, group in group_rows_by_columns(rows).items():
+                for start in range(0, len(group), SUPABASE_BATCH_SIZE):
+                    batch = group[start:start + SUPABASE_BATCH_SIZE]
+                    
+                    if self.supabase_url:
+                        # columns 參數只列出這組資料有的欄位；
+                        # on_conflict 讓同一學校在伺服器端直接更新，不需先查詢是否存在
+                        response = await self._get_http().post(
+                            f"{self.supabase_url}/rest/v1/schools",
+                            headers=self._supabase_headers(),
+                            params={'columns': ','.join(columns), 'on_conflict': 'nccu_page_url'},
+                            json=batch
+                        )
+                        response.raise_for_status()
+                    else:
+                        # 這裡需要實際的 Supabase MCP 調用
+                        # await mcp_supabase_upsert(table_name="schools", data=batch, on_conflict="nccu_page_url")
+                        pass
+                    
+                    logger.info(f"已儲存 {len(batch)} 筆")
+            
+            logger.info(f"成功儲存 {len(rows)} 筆學校資料")
             
         except Exception as e:
-            logger.error(f"儲存學校資料失敗 {school_data.get('name', 'Unknown')}: {e}")
+            logger.error(f"儲存學校資料失敗: {e}")
     
     def clean_school_data(self, school: Dict[str, Any]) -> Dict[str, Any]:
         """清理學校資料"""
-        cleaned = {}
-        
-        # 基本資訊
-        cleaned['name'] = school.get('name', '').strip()
-        cleaned['country'] = school.get('country', '').strip()
-        cleaned['city'] = school.get('city', '').strip()
-        cleaned['exchange_quota'] = school.get('exchange_quota')
-        cleaned['degree_types'] = school.get('degree_types', [])
-        
-        # 詳細資訊
-        cleaned['description'] = school.get('description', '').strip()
-        cleaned['official_website'] = school.get('official_website', '').strip()
-        cleaned['location_info'] = school.get('location_info', '').strip()
-        cleaned['image_url'] = school.get('image_url', '').strip()
-        cleaned['nccu_page_url'] = school.get('nccu_page_url', '').strip()
-        
-        # 移除空值
-        cleaned = {k: v for k, v in cleaned.items() if v is not None and v != ''}
-        
-        return cleaned
+        return clean_school_data(school)
     
-    async def save_to_json(self, filename: str = 'mcp_schools_data.json'):
-        """儲存資料到 JSON 檔案"""
+    async def save_to_json(self, filename: str = 'mcp_schools_data.json', compact: bool = True):
+        """儲存資料到 JSON 檔案；compact 時不縮排並以 gzip 壓縮寫入 <filename>.gz"""
         try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(self.schools_data, f, ensure_ascii=False, indent=2)
+            filename = dump_schools_json(self.schools_data, filename, compact)
             logger.info(f"資料已儲存到 {filename}")
         except Exception as e:
             logger.error(f"儲存 JSON 檔案失敗: {e}")
@@ -219,29 +531,30 @@ class MCPNCCUCrawler:
             # 創建 Supabase 資料表
             await self.create_supabase_table()
             
-            # 獲取總頁數
-            total_pages = await self.get_total_pages()
+            # 獲取總頁數，同時爬取一定需要的第一頁
+            total_pages, first_page = await asyncio.gather(
+                self.get_total_pages(),
+                self.crawl_school_list_page(0)
+            )
             logger.info(f"總共發現 {total_pages + 1} 頁")
             
-            # 爬取所有頁面
-            for page_num in range(total_pages + 1):
-                schools = await self.crawl_school_list_page(page_num)
-                
-                # 爬取詳細資訊並儲存
-                for school in schools:
-                    if school.get('nccu_page_url'):
-                        detail_info = await self.crawl_school_detail(school['nccu_page_url'])
-                        school.update(detail_info)
-                    
-                    # 儲存到 Supabase
-                    await self.save_to_supabase(school)
-                    self.schools_data.append(school)
-                    
-                    # 避免過度請求
-                    await asyncio.sleep(1)
-                
-                # 避免過度請求
-                await asyncio.sleep(2)
+            # 並行爬取其餘列表頁
+            all_schools = first_page + await self.crawl_school_list_pages(range(1, total_pages + 1))
+            
+            # 跳過其他分頁已出現過的學校，避免重複訪問詳細頁面
+            schools = self.filter_new_schools(all_schools)
+            
+            # 並行爬取詳細資訊，同時把已完成的學校分批寫入 Supabase
+            school_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            
+            async def produce() -> List[Dict[str, Any]]:
+                try:
+                    return await self.crawl_school_details(schools, school_queue)
+                finally:
+                    await school_queue.put(None)
+            
+            details, _ = await asyncio.gather(produce(), self.supabase_writer(school_queue, len(schools)))
+            self.schools_data.extend(details)
             
             # 儲存到 JSON 檔案
             await self.save_to_json()
@@ -250,6 +563,10 @@ class MCPNCCUCrawler:
             
         except Exception as e:
             logger.error(f"爬蟲執行失敗: {e}")
+        finally:
+            await self.close_browser()
+            await self.close_http()
+            self.close_cache()
 
 async def main():
     """主函數"""
@@ -5,14 +5,21 @@
 """
 
 import asyncio
-import json
+import hashlib
 import re
 import time
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Tuple, Union, Any
 from urllib.parse import urljoin, urlparse
 import logging
+from contextlib import asynccontextmanager
 from datetime import datetime
 
+import orjson
+from aiolimiter import AsyncLimiter
+from lxml import etree, html as lxml_html
+
+from school_storage import clean_school_data, group_rows_by_columns
+
 # 設置日誌
 logging.basicConfig(
     level=logging.INFO,
@@ -24,6 +31,90 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 瀏覽器分頁操作的預設逾時（毫秒）
+PAGE_TIMEOUT_MS = 15000
+
+# 等待頁面關鍵元素出現的逾時（毫秒）
+SELECTOR_TIMEOUT_MS = 10000
+
+# 頁面 DOM 載入後，代表解析所需內容已出現的元素；詳細頁面只要有介紹或任一外部連結即可開始解析
+LIST_READY_SELECTOR = 'table h3 a'
+DETAIL_READY_SELECTOR = 'p, a[href*="http"]'
+
+# 瀏覽器中不需載入的資源類型
+BLOCKED_RESOURCE_TYPES = frozenset({'image', 'font', 'stylesheet', 'media'})
+
+# 在瀏覽器內解析學校列表表格，回傳與 parse_school_cell 相同欄位的資料
+EXTRACT_SCHOOLS_JS = """
+() => Array.from(document.querySelectorAll('table tr td')).map(td => {
+    const link = td.querySelector('h3 a');
+    if (!link) return null;
+    const text = td.innerText;
+    const match = (re) => { const m = text.match(re); return m ? m[1] : null; };
+    const quota = match(/交換名額:\\s*(\\d+)/);
+    return {
+        name: link.textContent.trim() || null,
+        country: match(/國家:\\s*(\\S+)/),
+        city: match(/城市:\\s*(\\S+)/),
+        exchange_quota: quota === null ? null : parseInt(quota, 10),
+        degree_types: ['Bachelor', 'Master', 'Ph.D'].filter(k => text.includes(k)),
+        image_url: td.querySelector('img')?.src || null,
+        nccu_page_url: link.href || null
+    };
+}).filter(Boolean)
+"""
+
+# 學校資訊欄位與分頁連結的解析規則
+_RE_COUNTRY = re.compile(r'國家:\s*(\S+)')
+_RE_CITY = re.compile(r'城市:\s*(\S+)')
+_RE_QUOTA = re.compile(r'交換名額:\s*(\d+)')
+_RE_PAGE = re.compile(r'page=(\d+)')
+_NODE_RE = re.compile(r'/node/(\d+)')
+
+# 列表頁解析用的預編譯 XPath，所有列表頁與儲存格共用
+_XP_ROW = etree.XPath('//table//tr/td')
+_XP_NAME_LINK = etree.XPath('.//h3/a')
+_XP_IMG_SRC = etree.XPath('.//img/@src')
+_XP_PAGER_HREF = etree.XPath('//*[contains(@class, "pager")]//a/@href')
+
+# 詳細頁面中代表地理位置資訊的關鍵字
+LOCATION_KEYWORDS = ['Location', 'Address', '地址', '位置']
+
+# 在瀏覽器內一次找出含地理位置關鍵字的 <div> 文字
+EXTRACT_LOCATION_JS = """
+(keywords) => Array.from(document.querySelectorAll('div'))
+    .map(div => div.textContent)
+    .filter(text => text && keywords.some(k => text.includes(k)))
+    .map(text => text.trim())
+"""
+
+# 每次 POST 到 Supabase 的最大筆數
+SUPABASE_BATCH_SIZE = 500
+
+# 爬取與寫入 Supabase 之間的佇列容量
+PIPELINE_QUEUE_SIZE = 64
+
+# 爬取過程中逐筆附加的 ndjson 進度檔
+PROGRESS_FILENAME = 'schools_data.ndjson'
+
+# 頁面 HTML 快取目錄與有效期限（秒），重跑時直接讀取本機快取
+PAGE_CACHE_DIR = '.page_cache'
+PAGE_CACHE_TTL = 24 * 60 * 60
+
+# 回應未提供 Content-Type 時，以快取內容回應頁面所用的預設值
+DEFAULT_CONTENT_TYPE = 'text/html; charset=utf-8'
+
+# 本機狀態檔；記錄資料表是否已建立，之後執行時略過建表請求
+CRAWLER_STATE_FILE = '.crawler_state.json'
+SCHEMA_STATE_KEY = 'schema_initialized_v1'
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+def _school_key(url: Optional[str]) -> Optional[Union[int, str]]:
+    """以學校頁面的 node id 作為去重鍵，忽略查詢字串與結尾斜線的差異；不是 node 頁面時沿用原網址"""
+    match = _NODE_RE.search(url or '')
+    return int(match.group(1)) if match else url
+
 class NCCUSchoolCrawler:
     def __init__(self, supabase_url: str, supabase_key: str):
         """
@@ -36,9 +127,95 @@ class NCCUSchoolCrawler:
         self.supabase_url = supabase_url
         self.supabase_key = supabase_key
         self.base_url = "https://outgoing-iep.nccu.edu.tw"
-        self.schools_data = []
-        self.processed_schools = set()
+        # 以 _school_key 為鍵的學校資料，同時作為去重依據
+        self.schools_by_id: Dict[Union[int, str, None], Dict[str, Any]] = {}
+        self.http = None
+        self._supabase_http = None
+        self._cache = None
+        # 同時進行中的列表頁請求上限
+        self.list_concurrency = 5
+        # 同時開啟的詳細頁面分頁上限
+        self.detail_concurrency = 6
+        # 對來源網站的請求速率上限（每秒請求數），所有並行任務共用
+        self._limiter = AsyncLimiter(max_rate=5, time_period=1)
         
+    @property
+    def schools_data(self) -> List[Dict[str, Any]]:
+        """所有學校資料（依發現順序）"""
+        return list(self.schools_by_id.values())
+    
+    async def init_http_client(self):
+        """初始化共用的 httpx client，用於不需 JavaScript 的伺服器端渲染頁面"""
+        import httpx
+        self.http = httpx.AsyncClient(
+            http2=True,
+            headers={'User-Agent': USER_AGENT},
+            timeout=30,
+            follow_redirects=True
+        )
+    
+    @property
+    def _supabase_headers(self) -> Dict[str, str]:
+        """Supabase REST API 的認證標頭"""
+        return {
+            'apikey': self.supabase_key,
+            'Authorization': f'Bearer {self.supabase_key}',
+            'Content-Type': 'application/json'
+        }
+    
+    async def supabase_http(self):
+        """取得 Supabase 專用的長連線 client，所有寫入共用同一個連線池"""
+        if self._supabase_http is None:
+            import httpx
+            self._supabase_http = httpx.AsyncClient(
+                http2=True,
+                headers=self._supabase_headers,
+                timeout=30,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)
+            )
+        return self._supabase_http
+    
+    async def close_http_client(self):
+        """關閉共用的 httpx client"""
+        if self.http is not None:
+            await self.http.aclose()
+            self.http = None
+        if self._supabase_http is not None:
+            await self._supabase_http.aclose()
+            self._supabase_http = None
+    
+    def _get_cache(self):
+        """取得頁面 HTML 的磁碟快取（延遲建立）"""
+        if self._cache is None:
+            import diskcache
+            self._cache = diskcache.Cache(PAGE_CACHE_DIR)
+        return self._cache
+    
+    def close_cache(self):
+        """關閉頁面 HTML 快取"""
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+    
+    async def fetch_tree(self, url: str):
+        """以 httpx 取得靜態 HTML 並解析成 lxml 樹；失敗時回傳 None，由呼叫端改用瀏覽器"""
+        try:
+            cache = self._get_cache()
+            cached = cache.get(('static', url))
+            if cached is None:
+                async with self._limiter:
+                    response = await self.http.get(url)
+                response.raise_for_status()
+                cached = (response.content, response.encoding)
+                cache.set(('static', url), cached, expire=PAGE_CACHE_TTL)
+            
+            content, encoding = cached
+            parser = lxml_html.HTMLParser(encoding=encoding)
+            return lxml_html.fromstring(content, parser=parser)
+        except Exception as e:
+            logger.warning(f"靜態抓取失敗，改用瀏覽器 {url}: {e}")
+            return None
+    
     async def init_browser(self):
         """初始化 Playwright 瀏覽器"""
         try:
@@ -46,14 +223,26 @@ class NCCUSchoolCrawler:
             self.playwright = await async_playwright().start()
             self.browser = await self.playwright.chromium.launch(
                 headless=True,
-                args=['--no-sandbox', '--disable-dev-shm-usage']
+                args=[
+                    '--no-sandbox',
+                    '--disable-dev-shm-usage',
+                    '--disable-blink-features=AutomationControlled',
+                    '--disable-gpu',
+                    '--blink-settings=imagesEnabled=false'
+                ]
+            )
+            # 列表頁由伺服器端渲染，不需執行頁面 JavaScript；詳細頁面保留 JavaScript 以防內容需要動態載入
+            # 同類頁面共用同一個 context，每個任務各自開分頁即可並行
+            self.list_context = await self.browser.new_context(
+                user_agent=USER_AGENT,
+                java_script_enabled=False,
+                viewport={'width': 800, 'height': 600}
             )
-            self.page = await self.browser.new_page()
+            self.detail_context = await self.browser.new_context(user_agent=USER_AGENT)
             
-            # 設置用戶代理
-            await self.page.set_extra_http_headers({
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            })
+            # 只需要文字與 <img src> 屬性，圖片、字型、樣式表等資源一律不下載
+            for context in (self.list_context, self.detail_context):
+                await context.route('**/*', self._block_resource)
             
             logger.info("瀏覽器初始化完成")
             
@@ -61,6 +250,128 @@ class NCCUSchoolCrawler:
             logger.error(f"瀏覽器初始化失敗: {e}")
             raise
     
+    async def _block_resource(self, route):
+        """攔截解析用不到的資源類型"""
+        if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+            await route.abort()
+        else:
+            await route.continue_()
+    
+    @asynccontextmanager
+    async def open_page(self, context=None):
+        """
+        在共用 context 中開新分頁，離開時自動關閉
+        
+        Args:
+            context: 要使用的 context，預設為詳細頁面用的 detail_context
+        """
+        page = await (context or self.detail_context).new_page()
+        page.set_default_timeout(PAGE_TIMEOUT_MS)
+        try:
+            yield page
+        finally:
+            await page.close()
+    
+    async def load_page(self, page, url: str, ready_selector: str, prefetched=None):
+        """
+        在分頁中載入網址；快取中已有該頁原始回應時直接回應快取內容，不連線到網站
+        
+        以攔截主文件請求的方式回應快取，網址不變，頁面內的相對連結仍能正確解析。
+        快取的是伺服器回傳的原始內容（而非執行 JS 後的 DOM），與 remember_detail 計算雜湊的內容一致。
+        只等到 DOM 載入且 ready_selector 出現為止，不等待網路閒置；
+        ready_selector 逾時仍未出現時，以已載入的 DOM 繼續解析，但不寫入快取
+        
+        Args:
+            page: 要載入的分頁
+            url: 頁面網址
+            ready_selector: 代表解析所需內容已出現的 CSS selector
+            prefetched: 已由 httpx 取得的該頁 Response，提供時直接以其內容回應，不再連線
+        
+        Returns:
+            取得新內容並寫入快取時回傳 (headers, body)，否則回傳 None
+        """
+        from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+        
+        cache = self._get_cache()
+        fresh = None
+        if prefetched is not None:
+            fresh = (prefetched.headers, prefetched.content)
+            cached = (prefetched.content, prefetched.headers.get('content-type', DEFAULT_CONTENT_TYPE))
+        else:
+            cached = cache.get(('body', url))
+        
+        if cached is None:
+            async with self._limiter:
+                response = await page.goto(url, wait_until='domcontentloaded')
+            if response is not None and response.ok:
+                fresh = (response.headers, await response.body())
+        else:
+            cached_body, cached_type = cached
+            
+            async def fulfill(route):
+                await route.fulfill(body=cached_body, content_type=cached_type)
+            await page.route(lambda request_url: request_url == url, fulfill)
+            await page.goto(url, wait_until='domcontentloaded')
+        try:
+            await page.wait_for_selector(ready_selector, timeout=SELECTOR_TIMEOUT_MS)
+        except PlaywrightTimeoutError:
+            logger.warning(f"等待 {ready_selector} 逾時，以已載入的內容繼續解析: {url}")
+            return None
+        
+        if fresh is not None:
+            headers, body = fresh
+            cache.set(('body', url), (body, headers.get('content-type', DEFAULT_CONTENT_TYPE)), expire=PAGE_CACHE_TTL)
+        return fresh
+    
+    async def revalidate_detail(self, url: str) -> Tuple[Optional[Dict[str, Any]], Any]:
+        """
+        以條件式請求確認詳細頁面是否有變動
+        
+        Returns:
+            (上次的解析結果, 新取得的 Response)：
+            頁面回應 304 或內容雜湊與上次相同時，回傳 (上次的解析結果, None)；
+            頁面已變動時回傳 (None, Response)，由呼叫端以該內容重新解析，不必再下載一次；
+            沒有紀錄或請求失敗時回傳 (None, None)，由呼叫端重新爬取
+        """
+        cache = self._get_cache()
+        if ('body', url) in cache:
+            # 頁面快取仍有效，直接由快取載入即可，不需連線
+            return None, None
+        
+        meta = cache.get(('meta', url))
+        if meta is None:
+            return None, None
+        
+        headers = {}
+        if meta['etag']:
+            headers['If-None-Match'] = meta['etag']
+        if meta['last_modified']:
+            headers['If-Modified-Since'] = meta['last_modified']
+        
+        try:
+            async with self._limiter:
+                response = await self.http.get(url, headers=headers)
+        except Exception as e:
+            logger.warning(f"條件式請求失敗 {url}: {e}")
+            return None, None
+        
+        if response.status_code == 304:
+            return meta['detail_info'], None
+        if response.status_code == 200:
+            if hashlib.sha256(response.content).hexdigest() == meta['body_sha256']:
+                return meta['detail_info'], None
+            return None, response
+        return None, None
+    
+    def remember_detail(self, url: str, headers, body: bytes, detail_info: Dict[str, Any]):
+        """記錄詳細頁面的 ETag、Last-Modified、內容雜湊與解析結果，供下次條件式請求使用"""
+        self._get_cache().set(('meta', url), {
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+            'body_sha256': hashlib.sha256(body).hexdigest(),
+            'detail_info': detail_info
+        })
+    
     async def close_browser(self):
         """關閉瀏覽器"""
         if hasattr(self, 'browser'):
@@ -70,129 +381,128 @@ class NCCUSchoolCrawler:
         logger.info("瀏覽器已關閉")
     
     async def get_total_pages(self) -> int:
-        """獲取總頁數"""
+        """獲取總頁數（優先解析靜態 HTML，失敗時改用瀏覽器）"""
+        tree = await self.fetch_tree(f"{self.base_url}/school-list")
+        if tree is None:
+            return await self.get_total_pages_with_browser()
+        
+        max_page = 0
+        for href in _XP_PAGER_HREF(tree):
+            match = _RE_PAGE.search(href)
+            if match:
+                max_page = max(max_page, int(match.group(1)))
+        
+        return max_page if max_page > 0 else 1
+    
+    async def get_total_pages_with_browser(self) -> int:
+        """以瀏覽器獲取總頁數"""
         try:
-            await self.page.goto(f"{self.base_url}/school-list")
-            await self.page.wait_for_load_state('networkidle')
-            
-            # 檢查分頁資訊
-            pagination = await self.page.query_selector('.pager')
-            if pagination:
-                # 尋找最後一頁的連結
-                last_page_link = await pagination.query_selector('a[href*="last"]')
-                if last_page_link:
-                    href = await last_page_link.get_attribute('href')
-                    if href and 'page=' in href:
-                        match = re.search(r'page=(\d+)', href)
-                        if match:
-                            return int(match.group(1))
+            async with self.open_page(self.list_context) as page:
+                await self.load_page(page, f"{self.base_url}/school-list", LIST_READY_SELECTOR)
                 
-                # 如果沒有 last 連結，計算所有頁面連結
-                page_links = await pagination.query_selector_all('a[href*="page="]')
-                max_page = 0
-                for link in page_links:
-                    href = await link.get_attribute('href')
-                    if href:
-                        match = re.search(r'page=(\d+)', href)
-                        if match:
-                            page_num = int(match.group(1))
-                            max_page = max(max_page, page_num)
+                # 檢查分頁資訊
+                pagination = await page.query_selector('.pager')
+                if pagination:
+                    # 尋找最後一頁的連結
+                    last_page_link = await pagination.query_selector('a[href*="last"]')
+                    if last_page_link:
+                        href = await last_page_link.get_attribute('href')
+                        if href and 'page=' in href:
+                            match = _RE_PAGE.search(href)
+                            if match:
+                                return int(match.group(1))
+                    
+                    # 如果沒有 last 連結，計算所有頁面連結
+                    page_links = await pagination.query_selector_all('a[href*="page="]')
+                    max_page = 0
+                    for link in page_links:
+                        href = await link.get_attribute('href')
+                        if href:
+                            match = _RE_PAGE.search(href)
+                            if match:
+                                page_num = int(match.group(1))
+                                max_page = max(max_page, page_num)
+                    
+                    return max_page if max_page > 0 else 1
                 
-                return max_page if max_page > 0 else 1
-            
-            return 1
+                return 1
             
         except Exception as e:
             logger.error(f"獲取總頁數失敗: {e}")
             return 1
     
-    async def extract_school_basic_info(self, school_element) -> Dict[str, Any]:
-        """從學校元素中提取基本資訊"""
-        try:
-            # 學校名稱和連結
-            name_link = await school_element.query_selector('h3 a')
-            if not name_link:
-                return None
-            
-            school_name = await name_link.text_content()
-            school_url = await name_link.get_attribute('href')
-            if school_url:
-                school_url = urljoin(self.base_url, school_url)
-            
-            # 學校圖片
-            img_element = await school_element.query_selector('img')
-            image_url = None
-            if img_element:
-                image_url = await img_element.get_attribute('src')
-                if image_url:
-                    image_url = urljoin(self.base_url, image_url)
-            
-            # 提取詳細資訊
-            info_text = await school_element.text_content()
-            
-            # 國家
-            country_match = re.search(r'國家:\s*([^\s]+)', info_text)
-            country = country_match.group(1) if country_match else None
-            
-            # 城市
-            city_match = re.search(r'城市:\s*([^\s]+)', info_text)
-            city = city_match.group(1) if city_match else None
-            
-            # 交換名額
-            quota_match = re.search(r'交換名額:\s*(\d+)', info_text)
-            exchange_quota = int(quota_match.group(1)) if quota_match else None
-            
-            # 學位類型
-            degree_types = []
-            if 'Bachelor' in info_text:
-                degree_types.append('Bachelor')
-            if 'Master' in info_text:
-                degree_types.append('Master')
-            if 'Ph.D' in info_text:
-                degree_types.append('Ph.D')
-            
-            return {
-                'name': school_name.strip() if school_name else None,
-                'country': country,
-                'city': city,
-                'exchange_quota': exchange_quota,
-                'degree_types': degree_types,
-                'image_url': image_url,
-                'nccu_page_url': school_url
-            }
-            
-        except Exception as e:
-            logger.error(f"提取學校基本資訊失敗: {e}")
+    def parse_school_info_text(self, info_text: str) -> Dict[str, Any]:
+        """從學校欄位文字中解析國家、城市、交換名額與學位類型"""
+        # 國家
+        country_match = _RE_COUNTRY.search(info_text)
+        country = country_match.group(1) if country_match else None
+        
+        # 城市
+        city_match = _RE_CITY.search(info_text)
+        city = city_match.group(1) if city_match else None
+        
+        # 交換名額
+        quota_match = _RE_QUOTA.search(info_text)
+        exchange_quota = int(quota_match.group(1)) if quota_match else None
+        
+        # 學位類型
+        degree_types = []
+        if 'Bachelor' in info_text:
+            degree_types.append('Bachelor')
+        if 'Master' in info_text:
+            degree_types.append('Master')
+        if 'Ph.D' in info_text:
+            degree_types.append('Ph.D')
+        
+        return {
+            'country': country,
+            'city': city,
+            'exchange_quota': exchange_quota,
+            'degree_types': degree_types
+        }
+    
+    def parse_school_cell(self, cell) -> Optional[Dict[str, Any]]:
+        """從靜態 HTML 的表格儲存格（lxml 元素）中提取學校基本資訊"""
+        name_links = _XP_NAME_LINK(cell)
+        if not name_links:
             return None
+        name_link = name_links[0]
+        
+        school_url = name_link.get('href')
+        if school_url:
+            school_url = urljoin(self.base_url, school_url)
+        
+        image_url = None
+        image_srcs = _XP_IMG_SRC(cell)
+        if image_srcs:
+            image_url = urljoin(self.base_url, image_srcs[0])
+        
+        return {
+            'name': name_link.text_content().strip() or None,
+            **self.parse_school_info_text('\n'.join(cell.itertext())),
+            'image_url': image_url,
+            'nccu_page_url': school_url
+        }
     
     async def crawl_school_list_page(self, page_num: int) -> List[Dict[str, Any]]:
-        """爬取單頁學校列表"""
-        schools = []
-        
+        """爬取單頁學校列表，回傳該頁解析出的學校（尚未去重）"""
         try:
             url = f"{self.base_url}/school-list"
             if page_num > 0:
                 url += f"?page={page_num}"
             
             logger.info(f"正在爬取第 {page_num + 1} 頁: {url}")
-            await self.page.goto(url)
-            await self.page.wait_for_load_state('networkidle')
-            
-            # 等待表格載入
-            await self.page.wait_for_selector('table', timeout=10000)
             
-            # 找到所有學校元素
-            school_elements = await self.page.query_selector_all('table tr td')
+            # 列表頁由伺服器端渲染，優先以 httpx + lxml 解析；解析不到時才改用瀏覽器
+            school_infos = None
+            tree = await self.fetch_tree(url)
+            if tree is not None:
+                cells = _XP_ROW(tree)
+                school_infos = [info for info in map(self.parse_school_cell, cells) if info]
+            if not school_infos:
+                school_infos = await self.extract_school_list_with_browser(url)
             
-            for element in school_elements:
-                # 檢查是否包含學校資訊
-                school_info = await self.extract_school_basic_info(element)
-                if school_info and school_info['name']:
-                    # 檢查是否已處理過
-                    if school_info['nccu_page_url'] not in self.processed_schools:
-                        schools.append(school_info)
-                        self.processed_schools.add(school_info['nccu_page_url'])
-                        logger.info(f"發現學校: {school_info['name']}")
+            schools = [school_info for school_info in school_infos if school_info['name']]
             
             logger.info(f"第 {page_num + 1} 頁完成，發現 {len(schools)} 所學校")
             return schools
@@ -201,39 +511,61 @@ class NCCUSchoolCrawler:
             logger.error(f"爬取第 {page_num + 1} 頁失敗: {e}")
             return []
     
-    async def extract_school_detail_info(self, school_url: str) -> Dict[str, Any]:
-        """爬取學校詳細資訊"""
+    def register_schools(self, schools: List[Dict[str, Any]]):
+        """依序將學校加入 schools_by_id，已出現過的學校保留先加入的那一筆"""
+        for school_info in schools:
+            # 檢查是否已處理過
+            key = _school_key(school_info['nccu_page_url'])
+            if key not in self.schools_by_id:
+                self.schools_by_id[key] = school_info
+                logger.info(f"發現學校: {school_info['name']}")
+    
+    async def extract_school_list_with_browser(self, url: str) -> List[Dict[str, Any]]:
+        """以瀏覽器爬取單頁學校列表的基本資訊"""
+        async with self.open_page(self.list_context) as page:
+            await self.load_page(page, url, LIST_READY_SELECTOR)
+            
+            # 在瀏覽器內一次取出所有學校欄位，避免每個欄位一次 CDP 往返
+            return await page.evaluate(EXTRACT_SCHOOLS_JS)
+    
+    async def extract_school_detail_info(self, school_url: str, page, prefetched=None) -> Dict[str, Any]:
+        """
+        在指定分頁中爬取學校詳細資訊
+        
+        Args:
+            school_url: 詳細頁面網址
+            page: 要使用的分頁
+            prefetched: 條件式請求已取得的新內容，提供時不再重新下載頁面
+        """
         try:
             logger.info(f"正在爬取學校詳細資訊: {school_url}")
-            await self.page.goto(school_url)
-            await self.page.wait_for_load_state('networkidle')
+            fresh = await self.load_page(page, school_url, DETAIL_READY_SELECTOR, prefetched)
             
             detail_info = {}
             
             # 學校介紹
-            intro_element = await self.page.query_selector('p')
+            intro_element = await page.query_selector('p')
             if intro_element:
                 description = await intro_element.text_content()
                 detail_info['description'] = description.strip() if description else None
             
             # 學校官網
-            website_element = await self.page.query_selector('a[href*="http"]')
+            website_element = await page.query_selector('a[href*="http"]')
             if website_element:
                 website_url = await website_element.get_attribute('href')
                 if website_url and not website_url.startswith(self.base_url):
                     detail_info['official_website'] = website_url
             
             # 地理位置資訊
-            location_elements = await self.page.query_selector_all('div')
-            location_info = []
-            for element in location_elements:
-                text = await element.text_content()
-                if text and any(keyword in text for keyword in ['Location', 'Address', '地址', '位置']):
-                    location_info.append(text.strip())
+            location_info = await page.evaluate(EXTRACT_LOCATION_JS, LOCATION_KEYWORDS)
             
             if location_info:
                 detail_info['location_info'] = ' '.join(location_info)
             
+            if fresh is not None:
+                headers, body = fresh
+                self.remember_detail(school_url, headers, body, detail_info)
+            
             logger.info(f"學校詳細資訊爬取完成: {school_url}")
             return detail_info
             
@@ -241,103 +573,172 @@ class NCCUSchoolCrawler:
             logger.error(f"爬取學校詳細資訊失敗 {school_url}: {e}")
             return {}
     
-    async def crawl_all_schools(self):
-        """爬取所有學校資料"""
+    async def crawl_all_schools(self, school_queue: Optional[asyncio.Queue] = None):
+        """
+        爬取所有學校資料
+        
+        Args:
+            school_queue: 若提供，每所學校的詳細資訊完成後立即放入佇列供下游寫入
+        """
         try:
             total_pages = await self.get_total_pages()
             logger.info(f"總共發現 {total_pages + 1} 頁")
             
-            all_schools = []
+            # 並行爬取所有頁面，以 semaphore 限制同時請求數
+            semaphore = asyncio.Semaphore(self.list_concurrency)
             
-            # 爬取所有頁面
-            for page_num in range(total_pages + 1):
-                schools = await self.crawl_school_list_page(page_num)
-                all_schools.extend(schools)
-                
-                # 避免過度請求
-                await asyncio.sleep(2)
+            async def crawl_page(page_num: int) -> List[Dict[str, Any]]:
+                async with semaphore:
+                    return await self.crawl_school_list_page(page_num)
+            
+            results = await asyncio.gather(*[crawl_page(page_num) for page_num in range(total_pages + 1)])
+            
+            # gather 依頁碼順序回傳結果，依序登錄可讓資料順序與去重結果不受回應先後影響
+            for schools in results:
+                self.register_schools(schools)
+            total_schools = len(self.schools_by_id)
             
-            logger.info(f"總共發現 {len(all_schools)} 所學校")
+            logger.info(f"總共發現 {total_schools} 所學校")
             
-            # 爬取詳細資訊
-            for i, school in enumerate(all_schools):
+            # 並行爬取詳細資訊，每個任務在共用 context 中使用自己的分頁
+            detail_semaphore = asyncio.Semaphore(self.detail_concurrency)
+            completed = 0
+            
+            async def crawl_detail(key: Union[int, str, None]):
+                nonlocal completed
+                school = self.schools_by_id[key]
                 if school.get('nccu_page_url'):
-                    detail_info = await self.extract_school_detail_info(school['nccu_page_url'])
-                    school.update(detail_info)
-                    
-                    logger.info(f"進度: {i + 1}/{len(all_schools)} - {school['name']}")
+                    async with detail_semaphore:
+                        # 頁面未變動時沿用上次的解析結果，不必再開分頁渲染
+                        detail_info, fresh_response = await self.revalidate_detail(school['nccu_page_url'])
+                        if detail_info is not None:
+                            logger.info(f"詳細頁面未變動，沿用上次結果: {school['nccu_page_url']}")
+                        else:
+                            async with self.open_page() as page:
+                                detail_info = await self.extract_school_detail_info(
+                                    school['nccu_page_url'], page, fresh_response
+                                )
                     
-                    # 避免過度請求
-                    await asyncio.sleep(1)
+                    school.update(detail_info)
+                    completed += 1
+                    logger.info(f"進度: {completed}/{total_schools} - {school['name']}")
+                
+                if school_queue is not None:
+                    await school_queue.put(school)
+            
+            await asyncio.gather(*[crawl_detail(key) for key in list(self.schools_by_id)])
             
-            self.schools_data = all_schools
             logger.info("所有學校資料爬取完成")
             
         except Exception as e:
             logger.error(f"爬取所有學校資料失敗: {e}")
     
-    async def save_to_supabase(self):
-        """儲存資料到 Supabase"""
-        try:
-            import httpx
-            
-            headers = {
-                'apikey': self.supabase_key,
-                'Authorization': f'Bearer {self.supabase_key}',
-                'Content-Type': 'application/json',
-                'Prefer': 'return=minimal'
-            }
-            
-            # 首先創建 schools 表（如果不存在）
-            await self.create_schools_table()
-            
-            # 儲存學校資料
-            success_count = 0
-            error_count = 0
-            
-            for school in self.schools_data:
+    async def insert_schools(self, schools: List[Dict[str, Any]]) -> Tuple[int, int]:
+        """
+        清理學校資料並分批寫入 Supabase
+        
+        Returns:
+            (成功筆數, 失敗筆數)
+        """
+        success_count = 0
+        error_count = 0
+        
+        # 清理資料
+        payload = []
+        for school in schools:
+            try:
+                payload.append(self.clean_school_data(school))
+            except Exception as e:
+                error_count += 1
+                logger.error(f"清理學校資料失敗 {school.get('name', 'Unknown')}: {e}")
+        
+        # PostgREST 收到 JSON 陣列時會一次插入多筆；on_conflict 讓已存在的學校在伺服器端直接更新，
+        # 重跑時不會重複或違反唯一限制。依欄位分組送出，columns 只列出該組有的欄位，缺少的欄位不會被覆寫
+        client = await self.supabase_http()
+        for columns, rows in group_rows_by_columns(payload).items():
+            for start in range(0, len(rows), SUPABASE_BATCH_SIZE):
+                batch = rows[start:start + SUPABASE_BATCH_SIZE]
                 try:
-                    # 清理資料
-                    cleaned_school = self.clean_school_data(school)
+                    response = await client.post(
+                        f"{self.supabase_url}/rest/v1/schools",
+                        headers={'Prefer': 'resolution=merge-duplicates,return=minimal'},
+                        params={'columns': ','.join(columns), 'on_conflict': 'nccu_page_url'},
+                        json=batch
+                    )
                     
-                    # 插入資料
-                    async with httpx.AsyncClient() as client:
-                        response = await client.post(
-                            f"{self.supabase_url}/rest/v1/schools",
-                            headers=headers,
-                            json=cleaned_school
-                        )
-                        
-                        if response.status_code == 201:
-                            success_count += 1
-                            logger.info(f"成功儲存: {school['name']}")
-                        else:
-                            error_count += 1
-                            logger.error(f"儲存失敗 {school['name']}: {response.text}")
-                    
-                    # 避免過度請求
-                    await asyncio.sleep(0.5)
+                    if response.status_code == 201:
+                        success_count += len(batch)
+                        logger.info(f"成功儲存 {len(batch)} 筆")
+                    else:
+                        error_count += len(batch)
+                        logger.error(f"儲存失敗 {len(batch)} 筆: {response.text}")
                     
                 except Exception as e:
-                    error_count += 1
-                    logger.error(f"儲存學校資料失敗 {school.get('name', 'Unknown')}: {e}")
-            
-            logger.info(f"資料儲存完成: 成功 {success_count} 筆，失敗 {error_count} 筆")
-            
-        except Exception as e:
-            logger.error(f"儲存到 Supabase 失敗: {e}")
+                    error_count += len(batch)
+                    logger.error(f"儲存學校資料失敗 {len(batch)} 筆: {e}")
+        
+        return success_count, error_count
+    
+    async def supabase_writer(self, school_queue: asyncio.Queue):
+        """
+        從佇列取出已爬完的學校寫入 Supabase，收到 None 時結束
+        
+        每次取出佇列中已累積的所有學校一起送出，詳細頁面爬取期間即可陸續寫入；
+        同時逐筆附加到 PROGRESS_FILENAME，程式中斷時已爬取的資料不會遺失
+        """
+        success_count = 0
+        error_count = 0
+        await self.create_schools_table()
+        
+        with open(PROGRESS_FILENAME, 'wb') as progress:
+            done = False
+            while not done:
+                school = await school_queue.get()
+                if school is None:
+                    break
+                
+                batch = [school]
+                while len(batch) < SUPABASE_BATCH_SIZE and not school_queue.empty():
+                    school = school_queue.get_nowait()
+                    if school is None:
+                        done = True
+                        break
+                    batch.append(school)
+                
+                progress.write(b''.join(orjson.dumps(school) + b'\n' for school in batch))
+                progress.flush()
+                
+                try:
+                    success, errors = await self.insert_schools(batch)
+                except Exception as e:
+                    logger.error(f"儲存到 Supabase 失敗: {e}")
+                    success, errors = 0, len(batch)
+                success_count += success
+                error_count += errors
+        
+        logger.info(f"資料儲存完成: 成功 {success_count} 筆，失敗 {error_count} 筆")
+    
+    def load_state(self) -> Dict[str, Any]:
+        """讀取本機狀態檔，不存在或無法解析時回傳空字典"""
+        try:
+            with open(CRAWLER_STATE_FILE, 'rb') as f:
+                return orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            return {}
+    
+    def save_state(self, state: Dict[str, Any]):
+        """寫入本機狀態檔"""
+        with open(CRAWLER_STATE_FILE, 'wb') as f:
+            f.write(orjson.dumps(state, option=orjson.OPT_INDENT_2))
     
     async def create_schools_table(self):
-        """創建 schools 資料表"""
+        """創建 schools 資料表；曾經成功建立過時直接略過"""
+        state = self.load_state()
+        if state.get(SCHEMA_STATE_KEY):
+            logger.info("schools 資料表已建立，略過建表")
+            return
+        
         try:
-            import httpx
-            
-            headers = {
-                'apikey': self.supabase_key,
-                'Authorization': f'Bearer {self.supabase_key}',
-                'Content-Type': 'application/json'
-            }
-            
             # SQL 創建表語句
             create_table_sql = """
             CREATE TABLE IF NOT EXISTS schools (
@@ -355,51 +756,34 @@ class NCCUSchoolCrawler:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             );
+            CREATE UNIQUE INDEX IF NOT EXISTS schools_nccu_page_url_key ON schools (nccu_page_url);
             """
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.supabase_url}/rest/v1/rpc/exec_sql",
-                    headers=headers,
-                    json={'sql': create_table_sql}
-                )
-                
-                if response.status_code == 200:
-                    logger.info("schools 資料表創建成功")
-                else:
-                    logger.warning(f"創建資料表可能失敗: {response.text}")
+            client = await self.supabase_http()
+            response = await client.post(
+                f"{self.supabase_url}/rest/v1/rpc/exec_sql",
+                json={'sql': create_table_sql}
+            )
+            
+            if response.status_code == 200:
+                logger.info("schools 資料表創建成功")
+                state[SCHEMA_STATE_KEY] = True
+                self.save_state(state)
+            else:
+                logger.warning(f"創建資料表可能失敗: {response.text}")
             
         except Exception as e:
             logger.error(f"創建資料表失敗: {e}")
     
     def clean_school_data(self, school: Dict[str, Any]) -> Dict[str, Any]:
         """清理學校資料"""
-        cleaned = {}
-        
-        # 基本資訊
-        cleaned['name'] = school.get('name', '').strip()
-        cleaned['country'] = school.get('country', '').strip()
-        cleaned['city'] = school.get('city', '').strip()
-        cleaned['exchange_quota'] = school.get('exchange_quota')
-        cleaned['degree_types'] = school.get('degree_types', [])
-        
-        # 詳細資訊
-        cleaned['description'] = school.get('description', '').strip()
-        cleaned['official_website'] = school.get('official_website', '').strip()
-        cleaned['location_info'] = school.get('location_info', '').strip()
-        cleaned['image_url'] = school.get('image_url', '').strip()
-        cleaned['nccu_page_url'] = school.get('nccu_page_url', '').strip()
-        
-        # 移除空值
-        cleaned = {k: v for k, v in cleaned.items() if v is not None and v != ''}
-        
-        return cleaned
+        return clean_school_data(school)
     
     async def save_to_json(self, filename: str = 'schools_data.json'):
         """儲存資料到 JSON 檔案"""
         try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(self.schools_data, f, ensure_ascii=False, indent=2)
+            with open(filename, 'wb') as f:
+                f.write(orjson.dumps(self.schools_data, option=orjson.OPT_INDENT_2))
             logger.info(f"資料已儲存到 {filename}")
         except Exception as e:
             logger.error(f"儲存 JSON 檔案失敗: {e}")
@@ -409,24 +793,32 @@ class NCCUSchoolCrawler:
         try:
             logger.info("開始執行政大商學院締約學校爬蟲")
             
-            # 初始化瀏覽器
+            # 初始化 HTTP client 與瀏覽器
+            await self.init_http_client()
             await self.init_browser()
             
-            # 爬取所有學校資料
-            await self.crawl_all_schools()
+            # 爬取詳細資訊的同時，將已完成的學校交給 writer 寫入 Supabase
+            school_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            
+            async def produce():
+                try:
+                    await self.crawl_all_schools(school_queue)
+                finally:
+                    await school_queue.put(None)
+            
+            await asyncio.gather(produce(), self.supabase_writer(school_queue))
             
             # 儲存到 JSON 檔案
             await self.save_to_json()
             
-            # 儲存到 Supabase
-            await self.save_to_supabase()
-            
             logger.info("爬蟲執行完成")
             
         except Exception as e:
             logger.error(f"爬蟲執行失敗: {e}")
         finally:
+            await self.close_http_client()
             await self.close_browser()
+            self.close_cache()
 
 async def main():
     """主函數"""
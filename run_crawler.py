@@ -1,28 +1,28 @@
 #!/usr/bin/env python3
 """
 政大商學院締約學校爬蟲執行腳本
-使用 MCP 工具進行實際爬蟲和資料儲存
+預設執行 nccu_school_crawler 的 NCCUSchoolCrawler；設定 MOCK 環境變數時改用模擬資料流程
 """
 
 import asyncio
 import json
-import re
+import os
 from typing import Dict, List, Any
-from urllib.parse import urljoin
 import logging
 
-# 設置日誌
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# 日誌設定沿用 nccu_school_crawler
+from nccu_school_crawler import NCCUSchoolCrawler, main as crawler_main
+from school_storage import clean_school_data
+
 logger = logging.getLogger(__name__)
 
 class NCCUCrawlerWithMCP:
     def __init__(self):
-        """初始化爬蟲"""
+        """初始化模擬爬蟲（僅供 MOCK 模式測試流程使用，不會連線或寫入資料）"""
         self.base_url = "https://outgoing-iep.nccu.edu.tw"
         self.schools_data = []
+        # 同時進行中的頁面請求上限
+        self.concurrency = 5
         
     async def crawl_school_list(self):
         """爬取學校列表"""
@@ -31,19 +31,19 @@ class NCCUCrawlerWithMCP:
             
             # 使用 Playwright MCP 導航到主頁面
             # 這裡會使用實際的 MCP 調用
-            schools = []
-            
-            # 根據之前的分析，總共有 11 頁
-            for page_num in range(11):
-                logger.info(f"正在處理第 {page_num + 1} 頁...")
-                
-                # 這裡會使用 Playwright MCP 來獲取頁面內容
-                # 暫時使用模擬資料
-                page_schools = await self.extract_schools_from_page(page_num)
-                schools.extend(page_schools)
-                
-                # 避免過度請求
-                await asyncio.sleep(2)
+            semaphore = asyncio.Semaphore(self.concurrency)
+            
+            async def crawl_page(page_num: int) -> List[Dict[str, Any]]:
+                async with semaphore:
+                    logger.info(f"正在處理第 {page_num + 1} 頁...")
+                    
+                    # 這裡會使用 Playwright MCP 來獲取頁面內容
+                    # 暫時使用模擬資料
+                    return await self.extract_schools_from_page(page_num)
+            
+            # 根據之前的分析，總共有 11 頁，並行處理
+            results = await asyncio.gather(*[crawl_page(page_num) for page_num in range(11)])
+            schools = [school for page_schools in results for school in page_schools]
             
             self.schools_data = schools
             logger.info(f"總共發現 {len(schools)} 所學校")
@@ -91,16 +91,21 @@ class NCCUCrawlerWithMCP:
         try:
             logger.info("開始爬取學校詳細資訊...")
             
-            for i, school in enumerate(self.schools_data):
-                if school.get('nccu_page_url'):
+            semaphore = asyncio.Semaphore(self.concurrency)
+            
+            async def crawl_detail(i: int, school: Dict[str, Any]):
+                async with semaphore:
                     logger.info(f"正在處理 {i + 1}/{len(self.schools_data)}: {school['name']}")
                     
                     # 這裡會使用 Playwright MCP 來訪問詳細頁面
                     detail_info = await self.extract_school_detail(school['nccu_page_url'])
-                    school.update(detail_info)
-                    
-                    # 避免過度請求
-                    await asyncio.sleep(1)
+                school.update(detail_info)
+            
+            await asyncio.gather(*[
+                crawl_detail(i, school)
+                for i, school in enumerate(self.schools_data)
+                if school.get('nccu_page_url')
+            ])
             
             logger.info("學校詳細資訊爬取完成")
             
@@ -187,26 +192,7 @@ class NCCUCrawlerWithMCP:
     
     def clean_school_data(self, school: Dict[str, Any]) -> Dict[str, Any]:
         """清理學校資料"""
-        cleaned = {}
-        
-        # 基本資訊
-        cleaned['name'] = school.get('name', '').strip()
-        cleaned['country'] = school.get('country', '').strip()
-        cleaned['city'] = school.get('city', '').strip()
-        cleaned['exchange_quota'] = school.get('exchange_quota')
-        cleaned['degree_types'] = school.get('degree_types', [])
-        
-        # 詳細資訊
-        cleaned['description'] = school.get('description', '').strip()
-        cleaned['official_website'] = school.get('official_website', '').strip()
-        cleaned['location_info'] = school.get('location_info', '').strip()
-        cleaned['image_url'] = school.get('image_url', '').strip()
-        cleaned['nccu_page_url'] = school.get('nccu_page_url', '').strip()
-        
-        # 移除空值
-        cleaned = {k: v for k, v in cleaned.items() if v is not None and v != ''}
-        
-        return cleaned
+        return clean_school_data(school)
     
     async def save_to_json(self, filename: str = 'schools_data.json'):
         """儲存資料到 JSON 檔案"""
@@ -244,8 +230,11 @@ class NCCUCrawlerWithMCP:
 
 async def main():
     """主函數"""
-    crawler = NCCUCrawlerWithMCP()
-    await crawler.run()
+    if os.getenv('MOCK'):
+        crawler = NCCUCrawlerWithMCP()
+        await crawler.run()
+    else:
+        await crawler_main()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
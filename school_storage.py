@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+學校資料儲存的共用設定與工具
+各爬蟲共用的欄位、資料清理、JSON 輸出與 PostgreSQL COPY 寫入
+"""
+
+import gzip
+from typing import Dict, List, Tuple, Any
+import logging
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# 資料量超過此筆數時，JSON 改為逐筆串流寫入（不縮排）以降低記憶體峰值
+JSON_STREAM_THRESHOLD = 5000
+
+# 資料量超過此筆數且設定了 DATABASE_URL 時，改用 COPY 直接寫入資料庫
+COPY_THRESHOLD = 5000
+
+# schools 表可寫入的欄位，也是 COPY 的欄位順序
+SCHOOL_COLUMNS = (
+    'name', 'country', 'city', 'exchange_quota', 'degree_types', 'description',
+    'official_website', 'location_info', 'image_url', 'nccu_page_url'
+)
+
+# clean_school_data 的欄位規格：文字欄位去除空白，其他欄位原樣保留
+_STR_FIELDS = (
+    'name', 'country', 'city', 'description', 'official_website',
+    'location_info', 'image_url', 'nccu_page_url'
+)
+_PASS_FIELDS = ('exchange_quota', 'degree_types')
+
+def clean_school_data(school: Dict[str, Any]) -> Dict[str, Any]:
+    """清理學校資料（單次走訪，直接略過空值）"""
+    cleaned = {}
+
+    # 文字欄位：去除前後空白
+    for field in _STR_FIELDS:
+        value = school.get(field)
+        if value:
+            value = value.strip()
+            if value:
+                cleaned[field] = value
+
+    # 其他欄位：原樣保留
+    for field in _PASS_FIELDS:
+        value = school.get(field)
+        if value not in (None, [], ''):
+            cleaned[field] = value
+
+    return cleaned
+
+def group_rows_by_columns(rows: List[Dict[str, Any]]) -> Dict[Tuple[str, ...], List[Dict[str, Any]]]:
+    """
+    依每筆資料實際具有的欄位分組
+
+    clean_school_data 會移除空值欄位；upsert 時每組只送出自己有的欄位，
+    這次沒抓到的欄位就不會以 NULL 覆寫資料庫中既有的值
+    """
+    groups = {}
+    for row in rows:
+        columns = tuple(column for column in SCHOOL_COLUMNS if column in row)
+        groups.setdefault(columns, []).append(row)
+    return groups
+
+def dump_schools_json(schools: List[Dict[str, Any]], filename: str, compact: bool = True) -> str:
+    """
+    將學校資料寫入 JSON 檔案；compact 時不縮排並以 gzip 壓縮寫入 <filename>.gz
+
+    Returns:
+        實際寫入的檔名
+    """
+    if compact:
+        filename += '.gz'
+        f = gzip.open(filename, 'wb', compresslevel=3)
+    else:
+        f = open(filename, 'wb')
+
+    with f:
+        if len(schools) > JSON_STREAM_THRESHOLD:
+            f.write(b'[')
+            for i, school in enumerate(schools):
+                if i:
+                    f.write(b',')
+                f.write(orjson.dumps(school))
+            f.write(b']')
+        elif compact:
+            f.write(orjson.dumps(schools))
+        else:
+            f.write(orjson.dumps(schools, option=orjson.OPT_INDENT_2))
+    return filename
+
+async def copy_to_postgres(database_url: str, rows: List[Dict[str, Any]]):
+    """以 COPY 直接串流寫入 PostgreSQL，略過 PostgREST 的 JSON 解析（大量資料時使用）"""
+    import psycopg
+
+    columns = ', '.join(SCHOOL_COLUMNS)
+    # 暫存表中缺少的欄位為 NULL，合併時保留資料庫中既有的值
+    updates = ', '.join(f"{column} = COALESCE(EXCLUDED.{column}, schools.{column})" for column in SCHOOL_COLUMNS)
+    async with await psycopg.AsyncConnection.connect(database_url) as conn:
+        async with conn.cursor() as cur:
+            # 先 COPY 到暫存表，再以 ON CONFLICT 合併，重複執行時不會產生重複資料
+            await cur.execute(
+                f"CREATE TEMP TABLE schools_staging ON COMMIT DROP AS "
+                f"SELECT {columns} FROM schools WITH NO DATA"
+            )
+            async with cur.copy(f"COPY schools_staging ({columns}) FROM STDIN") as copy:
+                for row in rows:
+                    await copy.write_row(tuple(row.get(column) for column in SCHOOL_COLUMNS))
+            await cur.execute(
+                f"INSERT INTO schools ({columns}) SELECT {columns} FROM schools_staging "
+                f"ON CONFLICT (nccu_page_url) DO UPDATE SET {updates}, updated_at = CURRENT_TIMESTAMP"
+            )
+
+    logger.info(f"已透過 COPY 寫入 {len(rows)} 筆學校資料")